@@ -1,75 +1,227 @@
-from flask import Flask, render_template, request, send_file
-from PIL import Image, ImageEnhance
+from flask import Flask, Request, render_template, request, send_file
+from werkzeug.utils import secure_filename
+from PIL import Image, ImageStat
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import io
+import logging
+import multiprocessing
 import os
 import piexif
+from piexif._common import split_into_segments
 import random
 from datetime import datetime
+from functools import lru_cache
 import psycopg2  # For PostgreSQL database connection
+import threading
+
+# Use libjpeg-turbo directly for encoding when it is available, otherwise fall back to PIL (said once, by the main
+# process rather than every pool worker; PyTurboJPEG needs the libturbojpeg shared library, which pip doesn't install)
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError) as e:
+    turbo_jpeg = None
+    if multiprocessing.parent_process() is None:
+        logging.getLogger(__name__).warning(f"libjpeg-turbo unavailable, encoding JPEGs with PIL instead: {e}")
+
+# Request class that keeps uploaded files in memory; Werkzeug's default spills anything over 500 KB to a
+# temporary file on disk. Safe because MAX_CONTENT_LENGTH bounds the request body.
+class InMemoryRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+
+# Debug mode (reloader, interactive debugger) is opt-in for local development only
+DEBUG = os.environ.get('FLASK_DEBUG') == '1'
 
-# Folder to store images
-UPLOAD_FOLDER = 'static/images'
+# Folder to store images (set UPLOAD_FOLDER to a tmpfs path such as /dev/shm/img_upload to keep them in RAM)
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'static/images')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Reject uploads larger than this before parsing them (Flask answers with 413)
+MAX_CONTENT_LENGTH = 32 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+
+# Number of image processing worker processes per app process: IMAGE_WORKERS if set, otherwise the number of
+# CPUs this process may run on
+IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS', 0)) or (
+    len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count())
+
+# Pool of image processing workers, created on first use so the worker processes (which import this module)
+# don't each build a pool of their own
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+
+# Images are processed in memory; only keep a copy on disk when asked to (for debugging)
+app.config['SAVE_UPLOADS'] = os.environ.get('SAVE_UPLOADS') == '1'
+
 # Ensure the upload folder exists
-if not os.path.exists(UPLOAD_FOLDER):
+if app.config['SAVE_UPLOADS'] and not os.path.exists(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
-# Convert decimal degrees to degrees, minutes, seconds for EXIF
+# Every JPEG file starts with the SOI marker followed by another marker
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+# Random number generator for this process, reseeded in forked children (e.g. the worker pool) so they
+# don't all produce the same "random" values
+rng = random.Random()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=rng.seed)
+
+# Same quality as PIL's default JPEG encoder
+JPEG_QUALITY = 75
+
+# Number of image rows adjusted at a time
+STRIP_HEIGHT = 256
+
+# Rotations smaller than this many degrees are skipped; larger ones fill the exposed corners with mid grey,
+# which compresses better than black wedges
+MIN_ROTATION = 0.25
+ROTATION_FILL = (128, 128, 128)
+
+# Adjustment stages that can change no pixel by more than this many levels are skipped (so skipping both
+# stages changes the result by at most 1 level)
+SKIP_MAX_ERROR = 0.5
+
+# ITU-R 601-2 luma weights, as used by PIL when converting RGB to greyscale
+LUMA_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# Convert decimal degrees to degrees, minutes, seconds as EXIF rationals, keeping seconds to 1/100
+# (the sign is dropped; it goes in the N/S or E/W reference tag)
 def decimal_to_dms(deg):
-    d = int(deg)
-    m = int((deg - d) * 60)
-    s = int(((deg - d) * 60 - m) * 60)
-    return (d, m, s)
+    total = round(abs(deg) * 360000)  # Hundredths of an arcsecond
+    d, rem = divmod(total, 360000)
+    m, s = divmod(rem, 6000)
+    return ((d, 1), (m, 1), (s, 100))
+
+# Camera makes and models to pick from when not provided
+CAMERA_MODELS = {
+    "Canon": ("EOS 5D Mark IV", "Rebel T6", "EOS R"),
+    "Nikon": ("D850", "Z7", "D7500"),
+    "Sony": ("Alpha a7 III", "Alpha a6400"),
+    "Apple": ("iPhone 12 Pro", "iPhone X", "iPhone 13"),
+    "Samsung": ("Galaxy S21", "Galaxy Note 10"),
+    "GoPro": ("HERO9 Black", "HERO8 Black"),
+    "Huawei": ("P40 Pro", "Mate 30 Pro")
+}
+CAMERA_PAIRS = tuple((make, model) for make, models in CAMERA_MODELS.items() for model in models)
 
 # Randomize camera make and model if not provided
 def randomize_camera_data(camera_make=None, camera_model=None):
-    makes = ["Canon", "Nikon", "Sony", "Apple", "Samsung", "GoPro", "Huawei"]
-    models = {
-        "Canon": ["EOS 5D Mark IV", "Rebel T6", "EOS R"],
-        "Nikon": ["D850", "Z7", "D7500"],
-        "Sony": ["Alpha a7 III", "Alpha a6400"],
-        "Apple": ["iPhone 12 Pro", "iPhone X", "iPhone 13"],
-        "Samsung": ["Galaxy S21", "Galaxy Note 10"],
-        "GoPro": ["HERO9 Black", "HERO8 Black"],
-        "Huawei": ["P40 Pro", "Mate 30 Pro"]
-    }
+    if camera_make and camera_model:
+        return camera_make, camera_model
+    if camera_make in CAMERA_MODELS:
+        return camera_make, rng.choice(CAMERA_MODELS[camera_make])
+
+    random_make, random_model = rng.choice(CAMERA_PAIRS)
+    return camera_make or random_make, camera_model or random_model
+
+# Function to apply the colour adjustments to a strip of rows. Uses the blend formulas of PIL's ImageEnhance, but
+# only clips and rounds once at the end rather than after every stage, so the result approximates chained
+# enhancers (typically within a level or two, more where intermediate values would have been clipped).
+# When sharpening, the strip carries one extra row/column of edge pixels on every side for the kernel.
+def enhance_strip(strip, matrix, offset, sharpness):
+    # Contrast, brightness and color in one multiply-add per pixel
+    if matrix is None:
+        arr = strip.astype(np.float32)
+    else:
+        arr = np.matmul(strip, matrix, dtype=np.float32)
+        arr += offset
+
+    # Sharpness: blend with the image smoothed by PIL's SMOOTH kernel (3x3 ones, centre weight 5),
+    # rearranged as a weighted sum of the 3x3 box and the centre pixel
+    if sharpness is not None:
+        rows = arr[:-2] + arr[1:-1]
+        rows += arr[2:]
+        box = rows[:, :-2] + rows[:, 1:-1]
+        box += rows[:, 2:]
+        box *= (1 - sharpness) / 13
+        centre = arr[1:-1, 1:-1]
+        centre *= sharpness + 4 * (1 - sharpness) / 13
+        box += centre
+        arr = box
+
+    np.clip(arr, 0, 255, out=arr)
+    arr += 0.5
+    return arr.astype(np.uint8)
 
-    if not camera_make:
-        camera_make = random.choice(makes)
-    if not camera_model:
-        camera_model = random.choice(models[camera_make])
-    
-    return camera_make, camera_model
+# Function to get the pixels of an image as a uint8 array. Asks PIL's raw encoder for the whole image in one
+# chunk, which is about twice as fast as np.asarray (Image.tobytes encodes in 64 KB chunks and joins them).
+def image_to_array(img):
+    img.load()
+    bands = len(img.getbands())
+    encoder = Image._getencoder(img.mode, 'raw', img.mode)
+    encoder.setimage(img.im)
+    _, errcode, data = encoder.encode(img.width * img.height * bands)
+    if errcode != 1:  # Not finished in one chunk; fall back to PIL's own loop
+        return np.asarray(img)
+    return np.frombuffer(data, dtype=np.uint8).reshape(img.height, img.width, bands)
 
-# Function to apply random transformations to the image
+# Function to apply random transformations to the image, returning the pixels as a uint8 RGB array
 def apply_random_transformations(img):
-    img = img.rotate(random.uniform(-10, 10))  # Random rotation
-    enhancer = ImageEnhance.Contrast(img)
-    img = enhancer.enhance(random.uniform(0.8, 1.2))  # Random contrast adjustment
-    enhancer = ImageEnhance.Brightness(img)
-    img = enhancer.enhance(random.uniform(0.8, 1.2))  # Random brightness adjustment
-    enhancer = ImageEnhance.Color(img)
-    img = enhancer.enhance(random.uniform(0.9, 1.1))  # Random color enhancement
-    enhancer = ImageEnhance.Sharpness(img)
-    img = enhancer.enhance(random.uniform(0.9, 1.1))  # Random sharpness adjustment
-    return img
-
-# Function to add custom or randomized EXIF metadata to the image
-def add_custom_exif_metadata(image_path, output_path, camera_make, camera_model, date_taken, latitude, longitude):
-    img = Image.open(image_path)
-    img = apply_random_transformations(img)
-    camera_make, camera_model = randomize_camera_data(camera_make, camera_model)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    angle = rng.uniform(-10, 10)  # Random rotation
+    if abs(angle) > MIN_ROTATION:
+        img = img.rotate(angle, fillcolor=ROTATION_FILL)
+    contrast = rng.uniform(0.8, 1.2)  # Random contrast adjustment
+    brightness = rng.uniform(0.8, 1.2)  # Random brightness adjustment
+    color = rng.uniform(0.9, 1.1)  # Random color enhancement
+    sharpness = rng.uniform(0.9, 1.1)  # Random sharpness adjustment
 
-    lat_dms = decimal_to_dms(float(latitude)) if latitude else decimal_to_dms(random.uniform(-90, 90))
-    lon_dms = decimal_to_dms(float(longitude)) if longitude else decimal_to_dms(random.uniform(-180, 180))
+    # Contrast (blend with the mean grey level), brightness (scale towards black) and color (blend with
+    # greyscale) are all linear, so together they reduce to one 3x3 colour matrix plus an offset
+    scale = contrast * brightness
+    matrix = scale * (color * np.eye(3, dtype=np.float32) + (1 - color) * LUMA_WEIGHTS[:, np.newaxis])
 
-    if not date_taken:
-        date_taken = datetime.now().strftime("%Y:%m:%d %H:%M:%S")
+    # Skip stages whose combined effect is too small to see: the worst-case change over all pixel values
+    # (and, for the offset, all image means) for the colour stage, and over all 3x3 neighbourhoods for sharpness
+    coefficients = np.vstack([matrix - np.eye(3), np.full((1, 3), (1 - contrast) * brightness)])
+    colour_error = 255 * max(coefficients.clip(min=0).sum(axis=0).max(), -coefficients.clip(max=0).sum(axis=0).min())
+    if colour_error < SKIP_MAX_ERROR:
+        matrix = None
+    if 255 * 8 * abs(1 - sharpness) / 13 < SKIP_MAX_ERROR:
+        sharpness = None
+
+    pixels = image_to_array(img)
+    if matrix is None and sharpness is None:
+        return pixels
+
+    offset = 0
+    if matrix is not None:
+        mean = int(ImageStat.Stat(img.convert('L')).mean[0] + 0.5)
+        offset = mean * (1 - contrast) * brightness
+
+    # Work through the image in strips so the float32 temporaries stay small, like libvips' tile streaming
+    halo = 0 if sharpness is None else 1
+    out = np.empty_like(pixels)
+    height = pixels.shape[0]
+    for y0 in range(0, height, STRIP_HEIGHT):
+        y1 = min(y0 + STRIP_HEIGHT, height)
+        strip = pixels[max(y0 - halo, 0):y1 + halo]
+        if halo:
+            strip = np.pad(strip, ((int(y0 == 0), int(y1 == height)), (1, 1), (0, 0)), mode='edge')
+        out[y0:y1] = enhance_strip(strip, matrix, offset, sharpness)
+    return out
+
+# Function to encode a uint8 RGB array as JPEG with the given EXIF data
+def encode_jpeg(arr, exif_bytes):
+    out = io.BytesIO()
+    if turbo_jpeg:
+        jpeg_bytes = turbo_jpeg.encode(arr, quality=JPEG_QUALITY, pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420)
+        piexif.insert(exif_bytes, jpeg_bytes, out)  # Splice the EXIF segment in without re-encoding
     else:
-        date_taken = datetime.strptime(date_taken, "%Y-%m-%dT%H:%M").strftime("%Y:%m:%d %H:%M:%S")
+        Image.fromarray(arr).save(out, "jpeg", quality=JPEG_QUALITY, exif=exif_bytes)
+        out.seek(0)
+    return out
 
+# Function to serialise EXIF metadata
+def dump_exif(camera_make, camera_model, date_taken, lat_ref, lat_dms, lon_ref, lon_dms):
     exif_dict = {
         "0th": {
             piexif.ImageIFD.Make: camera_make.encode('utf-8'),
@@ -79,15 +231,86 @@ def add_custom_exif_metadata(image_path, output_path, camera_make, camera_model,
             piexif.ExifIFD.DateTimeOriginal: date_taken.encode('utf-8'),
         },
         "GPS": {
-            piexif.GPSIFD.GPSLatitudeRef: 'N' if float(latitude) >= 0 else 'S',
-            piexif.GPSIFD.GPSLatitude: ((lat_dms[0], 1), (lat_dms[1], 1), (lat_dms[2], 1)),
-            piexif.GPSIFD.GPSLongitudeRef: 'E' if float(longitude) >= 0 else 'W',
-            piexif.GPSIFD.GPSLongitude: ((lon_dms[0], 1), (lon_dms[1], 1), (lon_dms[2], 1)),
+            piexif.GPSIFD.GPSLatitudeRef: lat_ref,
+            piexif.GPSIFD.GPSLatitude: lat_dms,
+            piexif.GPSIFD.GPSLongitudeRef: lon_ref,
+            piexif.GPSIFD.GPSLongitude: lon_dms,
         }
     }
+    return piexif.dump(exif_dict)
+
+# Cached version of dump_exif, so repeat uploads with the same custom metadata (e.g. scripted clients) skip
+# piexif.dump. Only used when every value was supplied; randomized values would fill it with one-off entries.
+dump_exif_cached = lru_cache(maxsize=1024)(dump_exif)
+
+# Function to build EXIF bytes from custom or randomized metadata
+def build_exif(camera_make, camera_model, date_taken, latitude, longitude):
+    dump = dump_exif_cached if all((camera_make, camera_model, date_taken, latitude, longitude)) else dump_exif
+    camera_make, camera_model = randomize_camera_data(camera_make, camera_model)
+
+    latitude = float(latitude) if latitude else rng.uniform(-90, 90)
+    longitude = float(longitude) if longitude else rng.uniform(-180, 180)
+
+    if not date_taken:
+        date_taken = datetime.now().strftime("%Y:%m:%d %H:%M:%S")
+    else:
+        date_taken = datetime.strptime(date_taken, "%Y-%m-%dT%H:%M").strftime("%Y:%m:%d %H:%M:%S")
+
+    return dump(camera_make, camera_model, date_taken,
+                'N' if latitude >= 0 else 'S', decimal_to_dms(latitude),
+                'E' if longitude >= 0 else 'W', decimal_to_dms(longitude))
+
+# Function to transform the image and add custom or randomized EXIF metadata, returning the JPEG in memory
+def process_image(file_stream, camera_make, camera_model, date_taken, latitude, longitude, max_dim=None):
+    img = Image.open(file_stream)
+    if max_dim and max_dim > 0:
+        img.draft('RGB', (max_dim, max_dim))  # Let libjpeg decode straight to a reduced scale
+        img.thumbnail((max_dim, max_dim))
+    arr = apply_random_transformations(img)
+    exif_bytes = build_exif(camera_make, camera_model, date_taken, latitude, longitude)
+    return encode_jpeg(arr, exif_bytes)
+
+# Function to check whether a JPEG segment holds XMP (a non-Exif APP1) or Photoshop/IPTC (APP13) metadata
+def is_stale_metadata(segment):
+    marker = segment[:2]
+    return (marker == b'\xff\xe1' and segment[4:10] != b'Exif\x00\x00') or marker == b'\xff\xed'
+
+# Function to add custom or randomized EXIF metadata to raw JPEG bytes without touching the pixels. Other
+# metadata that could contradict it (XMP in non-Exif APP1 segments, Photoshop/IPTC in APP13) is dropped, as the
+# re-encoding path does.
+def add_exif_metadata(data, camera_make, camera_model, date_taken, latitude, longitude):
+    exif_bytes = build_exif(camera_make, camera_model, date_taken, latitude, longitude)
+    segments = [segment for segment in split_into_segments(data) if not is_stale_metadata(segment)]
+    out = io.BytesIO()
+    piexif.insert(exif_bytes, b''.join(segments), out)
+    return out
 
-    exif_bytes = piexif.dump(exif_dict)
-    img.save(output_path, "jpeg", exif=exif_bytes)
+# Function to process raw upload bytes in a worker process, returning the modified JPEG bytes
+def process_bytes(data, camera_make, camera_model, date_taken, latitude, longitude, max_dim=None):
+    return process_image(io.BytesIO(data), camera_make, camera_model, date_taken, latitude, longitude, max_dim).getvalue()
+
+# Function to get the worker pool, replacing it if it is broken (e.g. a worker was killed for using too much
+# memory, after which the pool can never run another job). Workers come from a forkserver where available,
+# since forking a multithreaded gunicorn worker can deadlock.
+def get_executor(broken=None):
+    global EXECUTOR
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None or EXECUTOR is broken:  # Another request may already have replaced a broken pool
+            if EXECUTOR is not None:
+                EXECUTOR.shutdown(wait=False)
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            EXECUTOR = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context(start_method))
+        return EXECUTOR
+
+# Function to run process_bytes in the worker pool. If the pool breaks, it is replaced for later requests but
+# the job is not retried: the upload that broke it would most likely just break the new pool too.
+def run_in_executor(*args):
+    executor = get_executor()
+    try:
+        return executor.submit(process_bytes, *args).result()
+    except BrokenProcessPool:
+        get_executor(broken=executor)
+        raise
 
 # Function to connect to the PostgreSQL database
 def connect_to_database():
@@ -119,27 +342,45 @@ def upload_image():
     if file.filename == '':
         return "No image selected", 400  # Return a 400 error
 
+    # Check the file is a JPEG before handing it to the decoder or the worker pool. The body has already been
+    # parsed by now, so this saves no I/O; MAX_CONTENT_LENGTH is what rejects oversized uploads up front.
+    head = file.stream.read(len(JPEG_MAGIC))
+    file.stream.seek(0)
+    if head != JPEG_MAGIC:
+        return "Only JPEG images are supported", 400  # Return a 400 error
+
     camera_make = request.form.get('camera_make')
     camera_model = request.form.get('camera_model')
     date_taken = request.form.get('date_taken')
     latitude = request.form.get('latitude')
     longitude = request.form.get('longitude')
+    max_dim = request.form.get('max_dim', type=int)  # Optional: shrink the output to fit within this many pixels
+    metadata_only = request.args.get('metadata_only') == '1'  # Optional: only replace the EXIF data
+    # Drop client paths and control characters (which would end up in the Content-Disposition header)
+    filename = os.path.basename(file.filename.replace('\\', '/'))
+    filename = ''.join(ch for ch in filename if ch.isprintable()).lstrip('.') or 'image.jpg'
 
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-    file.save(filepath)
-
-    output_path = os.path.join(app.config['UPLOAD_FOLDER'], f"modified_{file.filename}")
-    add_custom_exif_metadata(filepath, output_path, camera_make, camera_model, date_taken, latitude, longitude)
+    if metadata_only:
+        out = add_exif_metadata(file.read(), camera_make, camera_model, date_taken, latitude, longitude)
+    else:
+        # Run the CPU-bound transform and encode in a worker process so concurrent uploads aren't serialized on the GIL
+        try:
+            out = io.BytesIO(run_in_executor(file.read(), camera_make, camera_model, date_taken, latitude, longitude, max_dim))
+        except BrokenProcessPool:
+            return "Image processing failed", 500  # Return a 500 error
 
-    # Optional: Connect to the database to perform any operations
-    conn = connect_to_database()
-    if conn:
-        # Perform database operations if needed
-        conn.close()  # Close the connection
+    # Optional: keep a copy of the modified image on disk for debugging, named after a hash of its contents
+    # so simultaneous uploads with the same filename don't overwrite each other
+    if app.config['SAVE_UPLOADS']:
+        digest = hashlib.blake2b(out.getbuffer(), digest_size=8).hexdigest()
+        stem = secure_filename(os.path.splitext(filename)[0]) or 'image'
+        output_path = os.path.join(app.config['UPLOAD_FOLDER'], f"modified_{digest}_{stem}.jpg")
+        with open(output_path, 'wb') as f:
+            f.write(out.getbuffer())
 
-    return send_file(output_path, mimetype='image/jpeg', download_name=f"modified_{file.filename}", as_attachment=True)
+    return send_file(out, mimetype='image/jpeg', download_name=f"modified_{filename}", as_attachment=True)
 
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get("PORT", 5000)))
+    app.run(debug=DEBUG, host='0.0.0.0', port=int(os.environ.get("PORT", 5000)))
 
 